@@ -1,7 +1,4 @@
 import os
-
-os.environ["NUMEXPR_MAX_THREADS"] = "24"
-os.environ["OMP_NUM_THREADS"] = "24"
 import math
 import sys
 import h5py
@@ -12,11 +9,12 @@ import tempfile
 from glob import glob
 from tqdm import tqdm
 import concurrent.futures
+import multiprocessing
 from os.path import join as opj
 from molAnalyzer import molAnalyzer
 from scheduler import ComputationScheduler
 from trajManager import TrajectoryFileManager
-from utils import readPDBs, save_argparse, LoadFromFile
+from utils import readPDBs, save_argparse, LoadFromFile, str_or_none
 
 
 import warnings
@@ -36,6 +34,87 @@ def check_readers(coords, forces, numTrajFiles):
     else:
         return True
     
+def get_numa_nodes(cpus):
+    """Return the cores of each NUMA node, restricted to the given cores. If the NUMA
+    topology is not available (non Linux systems) all the cores are considered as a single node.
+    Parameters
+    ----------
+    cpus: list
+        The cores available to the process
+    """
+    nodes = []
+    for cpulist in sorted(glob("/sys/devices/system/node/node[0-9]*/cpulist")):
+        nodeCpus = []
+        with open(cpulist, "r") as f:
+            for field in f.read().strip().split(","):
+                if "-" in field:
+                    first, last = field.split("-")
+                    nodeCpus.extend(range(int(first), int(last) + 1))
+                elif field:
+                    nodeCpus.append(int(field))
+        nodeCpus = [cpu for cpu in nodeCpus if cpu in cpus]
+        if len(nodeCpus) > 0:
+            nodes.append(nodeCpus)
+    return nodes if len(nodes) > 0 else [cpus]
+
+def get_worker_slots(nodes, threadsPerWorker):
+    """Split the cores in disjoint slots of threadsPerWorker cores, following the order of the NUMA nodes.
+    Each slot lies within a single node or is made of whole nodes (e.g. one worker using all the cores), so
+    that no worker shares a node partially with another one. If the cores cannot be split this way None is returned.
+    Parameters
+    ----------
+    nodes: list
+        The cores of each NUMA node, see get_numa_nodes
+    threadsPerWorker: int
+        Number of cores of each slot
+    """
+    cpus = [cpu for nodeCpus in nodes for cpu in nodeCpus]
+    cpuNode = {cpu: i for i, nodeCpus in enumerate(nodes) for cpu in nodeCpus}
+    slots = []
+    for start in range(0, len(cpus) - threadsPerWorker + 1, threadsPerWorker):
+        slot = cpus[start : start + threadsPerWorker]
+        slotNodes = {cpuNode[cpu] for cpu in slot}
+        if len(slotNodes) > 1 and sum(len(nodes[node]) for node in slotNodes) != len(slot):
+            return None
+        slots.append(slot)
+    return slots if len(slots) > 0 else None
+
+def init_worker(workerCounter, numWorkers, threadsPerWorker):
+    """Initialize a worker of the process pool. On Linux, the worker is bound to its own set of cores.
+    The threads of the numerical libraries are limited by launch(), through the environment of the workers.
+    The cores are split in disjoint slots which follow the NUMA nodes (see get_worker_slots), so that the
+    arrays allocated by the worker are in local memory. If the cores cannot be split exactly in at least numWorkers
+    slots the worker is not bound.
+    Parameters
+    ----------
+    workerCounter: multiprocessing.Value
+        Counter shared by the workers, used to assign an id to each worker
+    numWorkers: int
+        Number of workers of the pool
+    threadsPerWorker: int
+        Number of threads (and cores) assigned to each worker
+    """
+    with workerCounter.get_lock():
+        workerId = workerCounter.value
+        workerCounter.value += 1
+
+    if not hasattr(os, "sched_setaffinity"):
+        return
+    slots = get_worker_slots(get_numa_nodes(sorted(os.sched_getaffinity(0))), threadsPerWorker)
+    if slots is None or len(slots) < numWorkers:
+        logger.info(f"The cores cannot be split in {numWorkers} slots of {threadsPerWorker} cores, worker {workerId} is not bound")
+        return
+    cpus = slots[workerId % len(slots)]
+    # the thread pools of the numerical libraries are already started when the module is imported,
+    # so all the threads of the worker are bound, not only the main one
+    tids = [int(tid) for tid in os.listdir("/proc/self/task")] if os.path.isdir("/proc/self/task") else [0]
+    for tid in tids:
+        try:
+            os.sched_setaffinity(tid, cpus)
+        except OSError:
+            # the thread has already exited
+            pass
+
 def get_argparse():
     parser = argparse.ArgumentParser(
         description="mdCATH dataset builder", prefix_chars="--"
@@ -54,11 +133,15 @@ def get_argparse():
     parser.add_argument('--trajDatasets', type=list, default=['rmsd', 'gyrationRadius', 'rmsf', 'dssp'], help='Trajectory datasets for each replica')
     parser.add_argument('--pdbAttrs', type=list, default=['numProteinAtoms', 'numResidues', 'numChains'], help='PDB attributes, shared by temperatures and replicas')
     parser.add_argument('--pdbDatasets', type=list, default=['element', 'z', 'resname', 'resid', 'chain'], help='PDB datasets, shared by temperatures and replicas')
+    parser.add_argument('--compression', type=str_or_none, default='gzip', help='Compression filter for the replica datasets (chunked storage), if None the datasets are stored contiguous')
+    parser.add_argument('--compressionOpts', type=int, default=None, help='Options of the compression filter, e.g. the gzip level (1 if None), must be None for filters without options such as lzf')
+    parser.add_argument('--useCoreDriver', action='store_true', help='Build each PDB file in memory (h5py core driver) and write it to disk on close, the whole file must fit in memory (for each of the pdbThreads)')
     parser.add_argument('--batchSize', type=int, default=1, help='batch size to use in the computation')
     parser.add_argument('--toRunBatches', type=int, default=None, help='Number of batches to run, if None all the batches will be run')
     parser.add_argument('--startBatch', type=int, default=None, help='Start batch, if None the first batch will be run')
     parser.add_argument('--endBatch', type=int, default=None, help='End batch, if None the last batch will be run')
-    parser.add_argument('--maxWorkers', type=int, default=24, help='Number of workers to use in the multiprocessing')
+    parser.add_argument('--maxWorkers', type=int, default=24, help='Number of workers to use in the multiprocessing, each one processes up to min(pdbThreads, batchSize) PDBs concurrently: lower it when pdbThreads > 1')
+    parser.add_argument('--pdbThreads', type=int, default=1, help='Number of threads used by each worker to process the PDBs of a batch, the cores of the worker are split among them. Each thread holds the trajectories and the chunk cache of its PDB in memory')
     # fmt: on
     return parser
 
@@ -97,43 +180,77 @@ def run(scheduler, args, batch_idx):
         The index of the batch to be processed
     """
     pdb_idxs = scheduler.process(batch_idx)
+    desc = pdb_idxs[0] if len(pdb_idxs) == 1 else "reading PDBs"
+    if args.pdbThreads <= 1 or len(pdb_idxs) == 1:
+        for pdb in tqdm(pdb_idxs, total=len(pdb_idxs), desc=desc):
+            run_pdb(pdb, args, batch_idx)
+        return
+    
+    # the PDBs of the batch are processed by a pool of threads, so that the reading of the trajectories
+    # of one PDB overlaps with the analysis and the writing of the others (each PDB has its own output file)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.pdbThreads) as executor:
+        futures = [executor.submit(run_pdb, pdb, args, batch_idx) for pdb in pdb_idxs]
+        for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures), desc=desc):
+            future.result()
+
+
+def run_pdb(pdb, args, batch_idx):
+    """Run the dataset generation for a single PDB, the result is written to its own h5 file.
+     Parameters
+    ----------
+    pdb: str
+        The name of the PDB to be processed
+    args: argparse.Namespace
+        The arguments from the command line
+    batch_idx: int
+        The index of the batch the PDB belongs to
+    """
+    resFile = opj(args.finaldatasetPath, pdb, f"mdcath_dataset_{pdb}.h5")
+    if os.path.exists(resFile):
+        logger.info(
+            f"File {resFile} already exists, skipping batch {batch_idx} for {pdb}"
+        )
+        return
+    
+    pdbFiles = glob(opj(args.gpugridInputsPath, pdb, "*/*.pdb")) # get structure.pdb from input folder (same for all replicas and temps)
+    if len(pdbFiles) == 0:
+        logger.warning(f"{pdb} does not exist")
+        return
+    pdbFilePath = pdbFiles[0]
+    
     trajFileManager = TrajectoryFileManager(
         args.gpugridResultsPath, args.concatTrajPath
     )
-    desc = pdb_idxs[0] if len(pdb_idxs) == 1 else "reading PDBs"
-    for pdb in tqdm(pdb_idxs, total=len(pdb_idxs), desc=desc):
-        with tempfile.TemporaryDirectory() as temp:
-            tmpFile = opj(temp, f"mdcath_dataset_{pdb}.h5")
-            tmplogfile = tmpFile.replace(".h5", ".txt")
-
-            resFile = opj(args.finaldatasetPath, pdb, f"mdcath_dataset_{pdb}.h5")
-            if os.path.exists(resFile):
-                logger.info(
-                    f"File {resFile} already exists, skipping batch {batch_idx} for {pdb}"
-                )
-                continue
-            logFile = opj(args.finaldatasetPath, pdb, f"log_{pdb}.txt")
-
-            pdbLogger = logging.getLogger(f"builder_{pdb}")
-            file_handler = logging.FileHandler(tmplogfile)
-            file_handler.setLevel(logging.INFO)
-            pdbLogger.addHandler(file_handler)
-            pdbLogger.setLevel(logging.INFO)
-                    
-            pdbLogger.info(f"Starting the dataset generation for {pdb} and batch {batch_idx}")
-            
-            pdbFilePath = glob(opj(args.gpugridInputsPath, pdb, "*/*.pdb"))[0] # get structure.pdb from input folder (same for all replicas and temps)
-            if not os.path.exists(pdbFilePath):
-                logger.warning(f"{pdb} does not exist")
-                continue
-            
-            os.makedirs(os.path.dirname(resFile), exist_ok=True)
-            
-            with h5py.File(tmpFile, "w", libver='latest') as h5:
+    logFile = opj(args.finaldatasetPath, pdb, f"log_{pdb}.txt")
+    # the h5 file is written next to its final location, so that it can be finalized
+    # with an atomic rename instead of copying the whole file
+    tmpFile = resFile + ".tmp"
+
+    with tempfile.TemporaryDirectory() as temp:
+        tmplogfile = opj(temp, f"log_{pdb}.txt")
+
+        pdbLogger = logging.getLogger(f"builder_{pdb}")
+        file_handler = logging.FileHandler(tmplogfile)
+        file_handler.setLevel(logging.INFO)
+        pdbLogger.addHandler(file_handler)
+        pdbLogger.setLevel(logging.INFO)
+                
+        pdbLogger.info(f"Starting the dataset generation for {pdb} and batch {batch_idx}")
+        
+        os.makedirs(os.path.dirname(resFile), exist_ok=True)
+        
+        try:
+            # with the core driver the file is built in memory and written to disk on close
+            driverOpts = {"driver": "core", "backing_store": True, "block_size": 16*1024*1024} if args.useCoreDriver else {}
+            # a large chunk cache keeps the chunks of a replica in memory until they are complete,
+            # avoiding to decompress and compress them again on partial writes
+            with h5py.File(tmpFile, "w", libver='latest', rdcc_nbytes=128*1024*1024, rdcc_nslots=100003, rdcc_w0=0.75, **driverOpts) as h5:
                 
-                h5.attrs["layout"] = "mdcath-only-protein-v1.0"
+                # v1.1: dssp stored as fixed-length bytes (S2) instead of variable-length strings
+                h5.attrs["layout"] = "mdcath-only-protein-v1.1"
                 pdbGroup = h5.create_group(pdb)
-                Analyzer = molAnalyzer(pdbFilePath, file_handler, os.path.dirname(resFile))
+                Analyzer = molAnalyzer(pdbFilePath, file_handler, os.path.dirname(resFile), loggerName=pdb)
+                # topology properties, computed once and shared by all temperatures and replicas
                 Analyzer.computeProperties()
 
                 for temp in args.temperatures:
@@ -155,8 +272,7 @@ def run(scheduler, args, batch_idx):
                             pdbLogger.error(e)
                             continue
 
-                        Analyzer.readXTC(trajFiles, batch_idx)
-                        Analyzer.readDCD(dcdFiles, batch_idx)
+                        Analyzer.readTrajectories(trajFiles, dcdFiles, batch_idx)
                         
                         status = check_readers(Analyzer.coords, Analyzer.forces, len(trajFiles)) # True if the number of frames is correct
                         if not status:
@@ -174,6 +290,8 @@ def run(scheduler, args, batch_idx):
                             replicaGroup=pdbTempReplGroup,
                             attrs=args.trajAttrs,
                             datasets=args.trajDatasets,
+                            compression=args.compression,
+                            compressionOpts=args.compressionOpts,
                         )
                         pdbLogger.info("\n")
 
@@ -182,7 +300,7 @@ def run(scheduler, args, batch_idx):
                     pdbLogger.error(
                         f"molAttrs not found for {pdb} and batch {batch_idx}"
                     )
-                    continue
+                    return
                 
                 # write the data to the h5 file for the molecule 
                 Analyzer.write_toH5(
@@ -192,11 +310,20 @@ def run(scheduler, args, batch_idx):
                     datasets=args.pdbDatasets,
                 )  
             
-            shutil.move(tmpFile, resFile)
+            os.replace(tmpFile, resFile)
             pdbLogger.info(
                 f"\n{pdb} batch {batch_idx} completed successfully added to mdCATH dataset: {args.finaldatasetPath}"
             )
-            shutil.move(tmplogfile, logFile)
+        finally:
+            # remove the partial file if the molecule was skipped or an error occurred
+            if os.path.exists(tmpFile):
+                os.unlink(tmpFile)
+            # detach the log file of this PDB
+            pdbLogger.removeHandler(file_handler)
+            logging.getLogger(f"MolAnalyzer.{pdb}").removeHandler(file_handler)
+            file_handler.close()
+
+        shutil.move(tmplogfile, logFile)
 
 
 def launch():
@@ -234,21 +361,35 @@ def launch():
     payload = Payload(scheduler, args)
 
     error_domains = open("errors.txt", "w")
-    results = []
-    with concurrent.futures.ProcessPoolExecutor(max_workers=args.maxWorkers) as executor:
+    # split the cores among the workers, and the cores of a worker among the PDBs it processes concurrently
+    # (at most pdbThreads, and no more than the PDBs of a batch), to avoid oversubscription
+    numCpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    threadsPerWorker = max(1, numCpus // args.maxWorkers)
+    concurrentPDBs = max(1, min(args.pdbThreads, args.batchSize))
+    threadsPerPDB = max(1, threadsPerWorker // concurrentPDBs)
+    logger.info(f"Cores per worker: {threadsPerWorker}, concurrent PDBs per worker: {concurrentPDBs}, threads per PDB: {threadsPerPDB}")
+    # the numerical libraries read the number of threads only when they are loaded, so the budget is set
+    # in the environment before creating the pool, and the workers are spawned (not forked) to load them again
+    for var in ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "NUMEXPR_NUM_THREADS", "NUMEXPR_MAX_THREADS"]:
+        os.environ[var] = str(threadsPerPDB)
+    mpContext = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=args.maxWorkers,
+        mp_context=mpContext,
+        initializer=init_worker,
+        initargs=(mpContext.Value("i", 0), args.maxWorkers, threadsPerWorker),
+    ) as executor:
         future_to_batch = {executor.submit(payload.runComputation, batch): batch for batch in toRunBatches}
         
         for future in tqdm(concurrent.futures.as_completed(future_to_batch), total=len(toRunBatches)):
             batch = future_to_batch[future]
             try:
-                result = future.result()
-                results.append(result)
+                # the results (None) are not kept
+                future.result()
             except Exception as e:
                 error_domains.write(f"Batch {batch} failed with exception: {e}\n")
                 # Optionally, log the error and continue with the next computation
 
-    return results
-
 
 if __name__ == "__main__":
     launch()
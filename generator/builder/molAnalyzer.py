@@ -1,4 +1,5 @@
 import os
+import zlib
 import logging
 import numpy as np
 from moleculekit.molecule import Molecule
@@ -14,6 +15,17 @@ logging.getLogger("moleculekit.bondguesser").setLevel(logging.CRITICAL)
 
 ANGSTROM_TO_NM = 0.1
 RMSD_CUTOFF = 40  # nm
+CHUNK_BYTES = 1024 * 1024  # target size of a chunk in the per-replica datasets
+# dtypes of the per-replica datasets. moleculekit already returns float32 arrays, the map pins
+# the stored dtypes so that they do not depend on the intermediate computations
+DATASET_DTYPES = {
+    "coords": np.float32,
+    "forces": np.float32,
+    "rmsd": np.float32,
+    "rmsf": np.float32,
+    "gyrationRadius": np.float32,
+    "box": np.float32,
+}
 
 def encodeDSSP(dssp):
     encodedDSSP = []
@@ -21,6 +33,67 @@ def encodeDSSP(dssp):
         encodedDSSP.append([x.encode("utf-8") for x in dssp[i]])
     return encodedDSSP
 
+def getChunkShape(shape, itemsize, chunkBytes=CHUNK_BYTES):
+    """Return a chunk shape which splits the array along its first axis (frames),
+    so that each chunk holds approximately chunkBytes.
+    Parameters
+    ----------
+    shape : tuple
+        The shape of the array to be written
+    itemsize : int
+        The size in bytes of one element of the array
+    chunkBytes : int
+        The target size in bytes of one chunk
+    """
+    frameBytes = max(1, int(np.prod(shape[1:])) * itemsize)
+    numFrames = min(shape[0], max(1, chunkBytes // frameBytes))
+    return (numFrames,) + tuple(shape[1:])
+
+def createDataset(h5group, name, data, compression=None, compressionOpts=None):
+    """Create a dataset in the h5 group. If a compression filter is given the dataset is chunked 
+    along the first axis (see getChunkShape) and compressed, together with the shuffle filter. 
+    Numeric arrays compressed with gzip are shuffled and compressed here and the chunks are written 
+    with write_direct_chunk, bypassing the HDF5 filter pipeline: zlib releases the GIL, so the PDBs 
+    processed by different threads are compressed in parallel.
+    Parameters
+    ----------
+    h5group : h5py.Group
+        The group of the h5 file where the dataset will be written
+    name : str
+        The name of the dataset
+    data : np.ndarray
+        The array to be written
+    compression : str
+        The compression filter (e.g. "gzip"), if None the dataset is stored contiguous
+    compressionOpts : int
+        The options of the compression filter, e.g. the gzip level (1 if None). Filters without options (lzf) require None
+    """
+    if compression is None or data.ndim == 0 or data.shape[0] == 0:
+        return h5group.create_dataset(name, data=data)
+    
+    chunks = getChunkShape(data.shape, data.dtype.itemsize)
+    if compression == "gzip" and compressionOpts is None:
+        compressionOpts = 1  # light compression by default
+    opts = {"chunks": chunks, "compression": compression, "shuffle": True}
+    if compressionOpts is not None:
+        opts["compression_opts"] = compressionOpts
+    if compression != "gzip" or data.dtype.kind not in "biuf":
+        return h5group.create_dataset(name, data=data, **opts)
+    
+    dset = h5group.create_dataset(name, shape=data.shape, dtype=data.dtype, **opts)
+    level = compressionOpts
+    itemsize = data.dtype.itemsize
+    for start in range(0, data.shape[0], chunks[0]):
+        # edge chunks are written full size, padded with zeros
+        chunk = np.zeros(chunks, dtype=data.dtype)
+        block = data[start : start + chunks[0]]
+        chunk[: block.shape[0]] = block
+        # shuffle filter: the bytes are grouped by their position in the element, then deflated
+        shuffled = chunk.view(np.uint8).reshape(-1, itemsize).T
+        offset = (start,) + (0,) * (data.ndim - 1)
+        dset.id.write_direct_chunk(offset, zlib.compress(shuffled.tobytes(), level))
+    return dset
+
 def txt_toH5(txtfile, h5group, dataset_name="pdb"):
     """Write the content of the txt file to the h5 group as a dataset.
     Parameters
@@ -53,7 +126,7 @@ def txt_toH5(txtfile, h5group, dataset_name="pdb"):
         raise ValueError(f"Unknown file type: {txtfile}")
 
 class molAnalyzer:
-    def __init__(self, pdbFile, file_handler=None, processed_path="."):
+    def __init__(self, pdbFile, file_handler=None, processed_path=".", loggerName=None):
         """MolAnalyzer class take care of the analysis of the molecule, it builds the molecule object and compute all a serires of properties
         this will be then used to generate a series othe h5dataset.
         Parameters
@@ -64,9 +137,12 @@ class molAnalyzer:
             The file handler to be used to write the log file
         processed_path : str
             The path where the processed files will be saved, in this case the filtered pdb file
+        loggerName : str
+            If given, the analyzer logs to its own child logger "MolAnalyzer.<loggerName>", so that the
+            file_handler only receives the messages of this molecule when several analyzers run in threads
         """
         self.processed_path = processed_path
-        self.molLogger = logging.getLogger("MolAnalyzer")
+        self.molLogger = logging.getLogger("MolAnalyzer" if loggerName is None else f"MolAnalyzer.{loggerName}")
         if file_handler is not None:
             self.molLogger.addHandler(file_handler)
         #logging.getLogger("moleculekit").handlers = [self.molLogger]
@@ -118,17 +194,30 @@ class molAnalyzer:
         self.molAttrs["numChains"] = len(set(list(self.molData["chain"])))
         self.molAttrs["numBonds"] = tmpmol.numBonds
 
-    def readXTC(self, xtcFiles, batch_idx):
-        """Read the xtc trajectory files
+    def readTrajectories(self, xtcFiles, dcdFiles, batch_idx):
+        """Read the xtc trajectory files and the dcd files of the forces of a replica.
+        The full molecule is copied only once: the forces are read first and the protein atoms are taken by index, 
+        then the coordinates are read in the same molecule which is finally filtered to the protein atoms.
         Parameters
         ----------
         xtcFiles : list
             The list of xtc files to be read
-        
+        dcdFiles : list
+            The list of dcd files to be read, one for each xtc file
         batch_idx : int
             The index of the batch to be used in the log file """
         
         self.trajmol = self.mol.copy()
+        try:
+            self.trajmol.read(dcdFiles)
+            self.forces = self.trajmol.coords[self.proteinIdxs]  # kcal/mol/Angstrom
+        except (RuntimeError, ValueError, OSError) as e:
+            self.molLogger.error(
+                f"FORCE LOADING ERROR ON BATCH:{batch_idx} | SIM: {os.path.basename(dcdFiles[0]).split('-')[0]}"
+            )
+            self.molLogger.error(e)
+            self.forces = None
+        
         try:
             self.trajmol.read(xtcFiles)
             self.trajmol.filter("protein")
@@ -143,23 +232,8 @@ class molAnalyzer:
         
         # COORDS 
         self.coords = self.trajmol.coords.copy()  # Angstrom (numAtoms, 3, numFrames)
-    
-    def readDCD(self, dcdFiles, batch_idx):
-        dcdmol = self.mol.copy()
-        try:
-            dcdmol.read(dcdFiles)
-            dcdmol.filter("protein")
-            self.forces = dcdmol.coords.copy()  # kcal/mol/Angstrom
-
-        except (RuntimeError, ValueError, OSError) as e:
-            self.molLogger.error(
-                f"FORCE LOADING ERROR ON BATCH:{batch_idx} | SIM: {os.path.basename(dcdFiles[0]).split('-')[0]}"
-            )
-            self.molLogger.error(e)
-            self.forces = None
-            return
         
-        if self.coords is not None:
+        if self.forces is not None:
             if self.forces.shape != self.coords.shape:
                 self.molLogger.warning(
                     f"Forces {self.forces.shape} and Coords {self.coords.shape} shapes do not match"
@@ -167,14 +241,13 @@ class molAnalyzer:
                 last_idx = min(self.forces.shape[2], self.coords.shape[2])
                 self.forces = self.forces[:, :, :last_idx]
                 self.coords = self.coords[:, :, :last_idx]
-            
     
     def trajAnalysis(self):
         """Perform the analysis of the trajectory"""
         
         if self.trajmol.numFrames != self.coords.shape[2]:
             # a mismatch between the number of frames in the trajectory and the number of frames in the coords
-            # can be found since in readDCD we take the minimum between forces and coords
+            # can be found since in readTrajectories we take the minimum between forces and coords
             self.trajmol.dropFrames(keep=np.arange(self.coords.shape[2]))
         
         self.trajAttrs = {}
@@ -212,8 +285,7 @@ class molAnalyzer:
                                     trajalnsel='name CA', refalnsel='name CA', centersel='protein', pbc=True)
         
         # the gyr_metric projection output rg, rg_x, rg_y, rg_z. We take only the first column which is the radius of gyration average over the three dimensions
-        # the dtype is set to float64 to have retrocompatibility with initial version of mdcath
-        # TODO: make everything float32 in future version of mdcath
+        # the metrics are stored as float32, see DATASET_DTYPES
         self.metricAnalysis["gyrationRadius"] = (gyr_metric.project(self.trajmol)[:, 0] * ANGSTROM_TO_NM).astype(np.float32)  # nm
 
         # RMSF
@@ -224,7 +296,9 @@ class molAnalyzer:
         # DSSP
         dssp_metric = MetricSecondaryStructure(sel="protein", simplified=False, integer=False)
         dssp = dssp_metric.project(self.trajmol)
-        self.metricAnalysis["dssp"] = np.array(encodeDSSP(dssp)).astype(object)
+        # fixed-length bytes instead of variable-length strings, so that the dataset has a fixed itemsize and can be compressed.
+        # The itemsize is pinned to 2 to hold the "NA" code, all the replicas have the same dtype (layout v1.1)
+        self.metricAnalysis["dssp"] = np.array(encodeDSSP(dssp), dtype="S2")
         
         # BOX
         # the box has shape (3, numFrames), we take the first frame only
@@ -250,7 +324,7 @@ class molAnalyzer:
         assert self.metricAnalysis["rmsf"].shape[0] == numResidues, f'rmsf shape {self.metricAnalysis["rmsf"].shape[0]} and numResidues {numResidues} do not match'
         assert self.metricAnalysis["dssp"].shape[0] == numFrames, f'dssp shape {self.metricAnalysis["dssp"].shape[0]} and numFrames {numFrames} do not match'
 
-    def write_toH5(self, molGroup, replicaGroup, attrs, datasets):
+    def write_toH5(self, molGroup, replicaGroup, attrs, datasets, compression=None, compressionOpts=None):
         """Write the data to the h5 file, according to the properties defined in the input for the dataset
         Parameters
         ----------
@@ -264,6 +338,10 @@ class molAnalyzer:
             list of attributes to be written in the h5 group
         datasets:
             list of datasets to be written in the h5 group
+        compression : str
+            The compression filter used for the replica datasets (e.g. "gzip"), if None they are stored contiguous
+        compressionOpts : int
+            The options of the compression filter, e.g. the gzip level
         """
         if molGroup is not None and replicaGroup is None:
             # write the pdb file to the h5 file
@@ -273,9 +351,7 @@ class molAnalyzer:
             # write the psf file to the h5 file
             txt_toH5(self.pdbFile.replace(".pdb", ".psf"), molGroup)
             # mol attributes
-            for key, value in self.molAttrs.items():
-                if key in attrs:
-                    molGroup.attrs[key] = value
+            molGroup.attrs.update({key: value for key, value in self.molAttrs.items() if key in attrs})
             # mol datasets
             for key, value in self.molData.items():
                 if key in datasets:
@@ -288,16 +364,17 @@ class molAnalyzer:
             # replica datasets
             for key, value in self.metricAnalysis.items():
                 if key in datasets:
-                    replicaGroup.create_dataset(key, data=value)
+                    value = value.astype(DATASET_DTYPES.get(key, value.dtype), copy=False)
+                    createDataset(replicaGroup, key, value, compression, compressionOpts)
                     if key == "dssp":
                         continue # dssp does not have unit
                     replicaGroup[key].attrs["unit"] = "nm"
 
-            replicaGroup.create_dataset("box", data=self.box)
+            replicaGroup.create_dataset("box", data=self.box.astype(DATASET_DTYPES["box"], copy=False))
 
             # coords and forces are written here using mdtraj function
-            replicaGroup.create_dataset("coords", data=self.coords)
-            replicaGroup.create_dataset("forces", data=self.forces)
+            createDataset(replicaGroup, "coords", self.coords.astype(DATASET_DTYPES["coords"], copy=False), compression, compressionOpts)
+            createDataset(replicaGroup, "forces", self.forces.astype(DATASET_DTYPES["forces"], copy=False), compression, compressionOpts)
             
             self.molLogger.info(f'coords shape: {self.coords.shape}')
             self.molLogger.info(f'forces shape: {self.forces.shape}')
@@ -19,6 +19,10 @@ class LoadFromFile(argparse.Action):
                 v = typ(v) if typ is not None else v
                 namespace.__dict__[k] = v
 
+def str_or_none(value):
+    """argparse type for optional strings, "none" (any case) is converted to None"""
+    return None if value.lower() == "none" else value
+
 def save_argparse(args, filename, exclude=None):
     if filename.endswith("yaml") or filename.endswith("yml"):
         if isinstance(exclude, str):
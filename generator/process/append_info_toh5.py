@@ -5,9 +5,12 @@
 
 import sys 
 import h5py 
+from contextlib import nullcontext
 import logging
 import numpy as np
 from tqdm import tqdm
+import itertools
+import concurrent.futures
 from os.path import join as opj
 from tools import get_secondary_structure_compositions, get_max_neighbors, get_solid_secondary_structure, readPDBs
 sys.path.append("/../builder/")
@@ -34,6 +37,97 @@ logger.addHandler(console_handler)
 logger.addHandler(file_handler)
 
 
+def compute_dom(dom, data_dir, basename, file_type, noh_mode):
+    """Read the information of a domain from its mdCATH h5 file, without writing anything.
+    It runs in a thread, the results are written to the destination file by the main thread
+    since HDF5 writes are not thread-safe.
+    Parameters:
+    dom: str
+        the domain to process
+    data_dir: str
+        the path to the directory containing the mdCATH dataset
+    basename: str
+        the basename of the mdCATH h5 files (mdcath or mdcath_noh)
+    file_type: str
+        the type of file to be written: source or analysis
+    noh_mode: bool
+        if True, the information will be extracted from the noh dataset
+    Returns:
+    result: dict
+        with the domain attributes ('attrs'), the replicas of each temperature ('temps'), each with
+        its own 'attrs' and 'datasets', and the replicas to be rechecked ('to_recheck')
+    """
+    source_file = f"{basename}_dataset_{dom}.h5"
+    result = {'attrs': {}, 'temps': {}, 'to_recheck': []}
+    # The noh dataset does not have the dssp information, to store it in the source file we need to read the dssp from the original dataset
+    # the reference file is opened once per domain, not for every replica
+    ref_file = opj('/workspace8/antoniom/mdcath_htmd', dom, f"mdcath_dataset_{dom}.h5")
+    use_ref = file_type == 'source' and noh_mode
+    with h5py.File(opj(data_dir, source_file), 'r', rdcc_nbytes=128*1024*1024, rdcc_nslots=100003, rdcc_w0=0.75) as source, \
+         (h5py.File(ref_file, 'r') if use_ref else nullcontext()) as ref_h5:
+        src_dom = source[dom]
+        result['attrs']['numResidues'] = src_dom.attrs['numResidues']
+        result['attrs']['numProteinAtoms'] = src_dom.attrs['numProteinAtoms']
+        result['attrs']['numChains'] = src_dom.attrs['numChains']
+        result['attrs']['numNoHAtoms'] = int(np.count_nonzero(src_dom['z'][:] != 1))
+        availample_temps = [t for t in ['320', '348', '379', '413', '450'] if t in src_dom.keys()]
+        for temp in availample_temps:
+            result['temps'][temp] = {}
+            for replica in src_dom[temp]:
+                rep = src_dom[temp][replica]
+                repl_result = {'attrs': {}, 'datasets': {}}
+                result['temps'][temp][replica] = repl_result
+                if 'numFrames' not in rep.attrs.keys():
+                    logger.error(f"numFrames not found in {dom} {temp} {replica}")
+                    continue
+                    
+                repl_result['attrs']['numFrames'] = rep.attrs['numFrames']
+                
+                if file_type == 'analysis':
+                    assert noh_mode == False, "Analysis file cannot be created for noh dataset"
+                    repl_result['datasets']['gyration_radius'] = rep['gyrationRadius'][:]
+                    repl_result['datasets']['rmsd'] = rep['rmsd'][:]
+                    repl_result['datasets']['rmsf'] = rep['rmsf'][:]
+                    repl_result['datasets']['box'] = rep['box'][:]
+                    
+                    try: 
+                        repl_result['datasets']['solid_secondary_structure'] = get_solid_secondary_structure(rep['dssp'][:])
+                    except Exception as e:
+                        logger.error(f"Error in {dom} {temp} {replica}")
+                        logger.error(e)
+                        result['to_recheck'].append(f"{dom} {temp} {replica}\n")
+                        continue
+                        
+                
+                elif file_type == 'source':
+                    if noh_mode:
+                        coords = rep['coords'][:]
+                        repl_result['attrs']['max_num_neighbors_5A'] = get_max_neighbors(coords, 5.5) # use 5.5 for confidence on the 5A
+                        repl_result['attrs']['max_num_neighbors_9A'] = get_max_neighbors(coords, 9.5) # use 9.5 for confidence on the 9A
+                        
+                        ref_rep = ref_h5[dom][temp][replica]
+                        gr = ref_rep['gyrationRadius'][:]
+                        repl_result['attrs']['min_gyration_radius'] = np.min(gr)
+                        repl_result['attrs']['max_gyration_radius'] = np.max(gr)
+                        
+                        alpha_comp, beta_comp, coil_comp = get_secondary_structure_compositions(ref_rep['dssp'][:1])
+
+                        repl_result['attrs']['alpha'] = alpha_comp
+                        repl_result['attrs']['beta'] = beta_comp
+                        repl_result['attrs']['coil'] = coil_comp
+                    else:
+                        gr = rep['gyrationRadius'][:]
+                        repl_result['attrs']['min_gyration_radius'] = np.min(gr)
+                        repl_result['attrs']['max_gyration_radius'] = np.max(gr)
+                        
+                        alpha_comp, beta_comp, coil_comp = get_secondary_structure_compositions(rep['dssp'][:1])
+
+                        repl_result['attrs']['alpha'] = alpha_comp
+                        repl_result['attrs']['beta'] = beta_comp
+                        repl_result['attrs']['coil'] = coil_comp
+    return result
+
+
 if __name__ == '__main__':
     # Define the h5 file for which the information will be modified
     origin_file = 'mdcath_analysis.h5'
@@ -44,77 +138,48 @@ if __name__ == '__main__':
     # Based on this different attributes will be written
     file_type = 'analysis' 
     noh_mode = False
+    max_workers = 8
     pdb_list = readPDBs(pdb_list)
     if file_type == 'analysis':
         to_recheck = open('log_doms_torecheck_mdcath_analysis_update.txt', 'a')
     basename = 'mdcath_noh' if noh_mode else 'mdcath' 
     
     with h5py.File(opj('h5files', origin_file), mode='a', libver='latest') as dest:
-        for dom in tqdm(pdb_list, total=len(pdb_list)):
-            source_file = f"{basename}_dataset_{dom}.h5"
-            if dom in dest:
-                del dest[dom]
-            
-            dom_group = dest.create_group(dom)
-            with h5py.File(opj(data_dir, source_file), 'r') as source:
-                    dom_group.attrs['numResidues'] = source[dom].attrs['numResidues']
-                    dom_group.attrs['numProteinAtoms'] = source[dom].attrs['numProteinAtoms']
-                    dom_group.attrs['numChains'] = source[dom].attrs['numChains']
-                    dom_group.attrs['numNoHAtoms'] = len([el for el in source[dom]['z'][:] if el != 1])
-                    availample_temps = [t for t in ['320', '348', '379', '413', '450'] if t in source[dom].keys()]
-                    for temp in availample_temps:
-                        temp_group = dom_group.create_group(temp)
-                        for replica in source[dom][temp]:
-                            repl_group = temp_group.create_group(replica)
-                            if 'numFrames' not in source[dom][temp][replica].attrs.keys():
-                                logger.error(f"numFrames not found in {dom} {temp} {replica}")
-                                continue
-                                
-                            repl_group.attrs['numFrames'] = source[dom][temp][replica].attrs['numFrames']
-                            
-                            if file_type == 'analysis':
-                                assert noh_mode == False, "Analysis file cannot be created for noh dataset"
-                                repl_group.create_dataset('gyration_radius', data = source[dom][temp][replica]['gyrationRadius'][:])
-                                repl_group.create_dataset('rmsd', data = source[dom][temp][replica]['rmsd'][:])
-                                repl_group.create_dataset('rmsf', data = source[dom][temp][replica]['rmsf'][:])
-                                repl_group.create_dataset('box', data = source[dom][temp][replica]['box'][:])
-                                
-                                try: 
-                                    solid_secondary_structure = np.zeros(source[dom][temp][replica]['dssp'].shape[0])
-                                    for i in range(source[dom][temp][replica]['dssp'].shape[0]):
-                                        solid_secondary_structure[i] = get_solid_secondary_structure(source[dom][temp][replica]['dssp'][i])
-                                    
-                                    repl_group.create_dataset('solid_secondary_structure', data=solid_secondary_structure)
-                                except Exception as e:
-                                    logger.error(f"Error in {dom} {temp} {replica}")
-                                    logger.error(e)
-                                    to_recheck.write(f"{dom} {temp} {replica}\n")
-                                    continue
-                                    
-                            
-                            elif file_type == 'source':
-                                if noh_mode:
-                                    repl_group.attrs['max_num_neighbors_5A'] = get_max_neighbors(source[dom][temp][replica]['coords'][:], 5.5) # use 5.5 for confidence on the 5A
-                                    repl_group.attrs['max_num_neighbors_9A'] = get_max_neighbors(source[dom][temp][replica]['coords'][:], 9.5) # use 9.5 for confidence on the 9A
-                                    
-                                    # The noh dataset does not have the dssp information, to store it in the source file we need to read the dssp from the original dataset                             
-                                    with h5py.File(opj('/workspace8/antoniom/mdcath_htmd', dom, f"mdcath_dataset_{dom}.h5"), "r") as ref_h5:
-                                        repl_group.attrs['min_gyration_radius'] = np.min(ref_h5[dom][temp][replica]['gyrationRadius'][:])
-                                        repl_group.attrs['max_gyration_radius'] = np.max(ref_h5[dom][temp][replica]['gyrationRadius'][:])
-                                        
-                                        alpha_comp, beta_comp, coil_comp = get_secondary_structure_compositions(ref_h5[dom][temp][replica]['dssp'])
-
-                                        repl_group.attrs['alpha'] = alpha_comp
-                                        repl_group.attrs['beta'] = beta_comp
-                                        repl_group.attrs['coil'] = coil_comp
-                                else:
-                                    repl_group.attrs['min_gyration_radius'] = np.min(source[dom][temp][replica]['gyrationRadius'][:])
-                                    repl_group.attrs['max_gyration_radius'] = np.max(source[dom][temp][replica]['gyrationRadius'][:])
-                                    
-                                    alpha_comp, beta_comp, coil_comp = get_secondary_structure_compositions(source[dom][temp][replica]['dssp'])
-
-                                    repl_group.attrs['alpha'] = alpha_comp
-                                    repl_group.attrs['beta'] = beta_comp
-                                    repl_group.attrs['coil'] = coil_comp
+        # the source files are read by a pool of threads, the destination file is written only by the main thread.
+        # At most 2*max_workers domains are read ahead of the writer, so only their results are kept in memory
+        doms_to_submit = iter(pdb_list)
+        future_to_dom = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as executor, tqdm(total=len(pdb_list)) as pbar:
+            try:
+                while True:
+                    for dom in itertools.islice(doms_to_submit, 2 * max_workers - len(future_to_dom)):
+                        future_to_dom[executor.submit(compute_dom, dom, data_dir, basename, file_type, noh_mode)] = dom
+                    if len(future_to_dom) == 0:
+                        break
+                    done, _ = concurrent.futures.wait(future_to_dom, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        dom = future_to_dom.pop(future)
+                        result = future.result()
+                        if dom in dest:
+                            del dest[dom]
+                        
+                        dom_group = dest.create_group(dom)
+                        dom_group.attrs.update(result['attrs'])
+                        for temp, replicas in result['temps'].items():
+                            temp_group = dom_group.create_group(temp)
+                            for replica, repl_result in replicas.items():
+                                repl_group = temp_group.create_group(replica)
+                                repl_group.attrs.update(repl_result['attrs'])
+                                for name, data in repl_result['datasets'].items():
+                                    repl_group.create_dataset(name, data=data, track_times=False)
+                        for line in result['to_recheck']:
+                            to_recheck.write(line)
 
-            logger.info(f"Successfully updated information for {dom}")
\ No newline at end of file
+                        # flush once per domain, all the groups and datasets of the domain are written
+                        dest.flush()
+                        logger.info(f"Successfully updated information for {dom}")
+                        pbar.update(1)
+            except Exception:
+                # stop at the first error, without reading the domains still queued
+                executor.shutdown(wait=True, cancel_futures=True)
+                raise
\ No newline at end of file
@@ -1,5 +1,8 @@
 import numpy as np
 
+# all the codes produced by the dssp (MetricSecondaryStructure, simplified=False) in the mdCATH dataset
+DSSP_CODES = [b"H", b"B", b"E", b"G", b"I", b"T", b"S", b" ", b"NA"]
+
 def readPDBs(pdbList):
     if isinstance(pdbList, list):
         return pdbList
@@ -9,29 +12,29 @@ def readPDBs(pdbList):
             pdblist.append(line.strip())
     return sorted(pdblist)
 
+def check_dssp_codes(dssp):
+    """Raise a ValueError if the dssp array (bytes) contains codes which are not in DSSP_CODES,
+    so that malformed replicas are flagged instead of being counted as coil."""
+    unknown = np.setdiff1d(np.unique(dssp), DSSP_CODES)
+    if unknown.size > 0:
+        raise ValueError(f"Unknown dssp codes: {unknown.tolist()}")
+
 def get_secondary_structure_compositions(dssp):
     '''This funtcion returns the percentage composition of alpha, beta and coil in the protein.
     A special "NA" code will be assigned to each "residue" in the topology which isn"t actually 
     a protein residue (does not contain atoms with the names "CA", "N", "C", "O")
+    The composition is computed on the first frame of dssp, an array of shape (num_frames, num_residues),
+    so only the first frame needs to be read from the h5 file.
     '''
-    floatMap = {"H": 0, "B": 1, "E": 1, "G": 0, "I": 0, "T": 2, "S": 2, " ": 2, 'NA': 3} 
-    
-    decoded_dssp = [el.decode() for el in dssp[0]]
-    float_dssp = np.array([floatMap[el] for el in decoded_dssp])
-    unique, counts = np.unique(float_dssp, return_counts=True)
-    numResAlpha, numResBeta, numResCoil = 0, 0, 0
-    for u, c in zip(unique, counts):
-        if u == 0:
-            numResAlpha += c
-        elif u == 1:
-            numResBeta += c
-        else:
-            # NA or Coil
-            numResCoil += c
+    # alpha (H, G, I) and beta (B, E) codes, everything else is coil or NA
+    first_frame = np.asarray(dssp[0]).astype("S")
+    numResAlpha = np.count_nonzero(np.isin(first_frame, [b"H", b"G", b"I"]))
+    numResBeta = np.count_nonzero(np.isin(first_frame, [b"B", b"E"]))
+    numResCoil = first_frame.size - numResAlpha - numResBeta
     # percentage composition in alpha, beta and coil
-    alpha_comp = (numResAlpha / np.sum(counts)) * 100
-    beta_comp = (numResBeta / np.sum(counts)) * 100
-    coil_comp = (numResCoil / np.sum(counts)) * 100
+    alpha_comp = (numResAlpha / first_frame.size) * 100
+    beta_comp = (numResBeta / first_frame.size) * 100
+    coil_comp = (numResCoil / first_frame.size) * 100
     
     return alpha_comp, beta_comp, coil_comp
 
@@ -48,28 +51,23 @@ def get_max_neighbors(coords, distance):
     max_neighbors = 0
     for i in range(coords.shape[0]):
         tree = cKDTree(coords[i])
-        # Query the tree to find neighbors within the specified distance
-        num_neighbors = tree.query_ball_tree(tree, distance)
+        # Count the neighbors of each atom within the specified distance, without building the lists of neighbors
+        num_neighbors = tree.query_ball_point(coords[i], distance, return_length=True)
         # Get the maximum number of neighbors for this conformation
-        max_neighbors = max(max_neighbors, max(len(n) for n in num_neighbors))
+        max_neighbors = max(max_neighbors, int(num_neighbors.max()))
     return max_neighbors
 
 def get_solid_secondary_structure(dssp):
-    """ This function returns the percentage of solid secondary structure in the protein, computed as 
-    the sum of alpha and beta residues over the total number of residues."""
-    floatMap = {"H": 0, "B": 1, "E": 1, "G": 0, "I": 0, "T": 2, "S": 2, " ": 2, 'NA': 3}     
-    decoded_dssp = [el.decode() for el in dssp]
-    float_dssp = np.array([floatMap[el] for el in decoded_dssp])
-    unique, counts = np.unique(float_dssp, return_counts=True)
-    numResAlpha, numResBeta, numResCoil = 0, 0, 0
-    for u, c in zip(unique, counts):
-        if u == 0:
-            numResAlpha += c
-        elif u == 1:
-            numResBeta += c
-        else:
-            # NA or Coil
-            numResCoil += c
-    
-    solid_secondary_structure = (numResAlpha+numResBeta)/np.sum(counts)
-    return solid_secondary_structure
\ No newline at end of file
+    """ This function returns the fraction of solid secondary structure in the protein, computed as 
+    the sum of alpha and beta residues over the total number of residues.
+    Parameters:
+    dssp: np.array, shape=(num_frames, num_residues) or (num_residues,), the dssp codes as bytes
+    Returns:
+    solid_secondary_structure: np.array, shape=(num_frames,), or a float if a single frame is given
+    """
+    # alpha (H, G, I) and beta (B, E) codes, everything else is coil or NA
+    solid_codes = [b"H", b"G", b"I", b"B", b"E"]
+    dssp = np.asarray(dssp).astype("S")
+    check_dssp_codes(dssp)
+    solid = np.isin(dssp, solid_codes)
+    return solid.mean(axis=-1)
@@ -5,9 +5,8 @@ import os
 import sys 
 import h5py 
 import math 
-import shutil
 import logging
-import tempfile
+from contextlib import nullcontext
 import numpy as np
 from tqdm import tqdm
 import concurrent.futures
@@ -57,8 +56,10 @@ def run(scheduler, batch_idx, data_dir, output_dir='.', file_type='source', noh=
     file_name = f"{basename}_{file_type}_{batch_idx}.h5"
     resfile = opj(output_dir, file_name)
     
-    with tempfile.NamedTemporaryFile() as tmp:
-        tmp_file = tmp.name
+    # the temporary file is written next to the batch file, so that it can be finalized
+    # with an atomic rename instead of copying the whole file (h5py creates it with the umask mode)
+    tmp_file = resfile + ".tmp"
+    try:
         with h5py.File(tmp_file, "w", libver='latest') as h5:
             for i, pdb in tqdm(enumerate(pdb_idxs), total=len(pdb_idxs), desc=f"processing batch {batch_idx}"):                
                 h5_file = opj(data_dir, f"{basename}_dataset_{pdb}.h5")
@@ -67,11 +68,15 @@ def run(scheduler, batch_idx, data_dir, output_dir='.', file_type='source', noh=
                     continue
                                 
                 group = h5.create_group(pdb)
-                with h5py.File(h5_file, "r") as origin:
+                # The noh dataset does not have the dssp information, to store it in the source file we need to read the dssp from the original dataset
+                # the reference file is opened once per domain, not for every replica
+                ref_file = opj('/workspace3/mdcath', f"mdcath_dataset_{pdb}.h5")
+                use_ref = file_type == 'source' and noh
+                with h5py.File(h5_file, "r") as origin, (h5py.File(ref_file, "r") if use_ref else nullcontext()) as ref_h5:
                     group.attrs['numResidues'] = origin[pdb].attrs['numResidues']
                     group.attrs['numProteinAtoms'] = origin[pdb].attrs['numProteinAtoms']
                     group.attrs['numChains'] = origin[pdb].attrs['numChains']
-                    group.attrs['numNoHAtoms'] = len([el for el in origin[pdb]['z'][:] if el != 1])
+                    group.attrs['numNoHAtoms'] = int(np.count_nonzero(origin[pdb]['z'][:] != 1))
                     availample_temps = [t for t in ['320', '348', '379', '413', '450'] if t in origin[pdb].keys()]
                     for temp in availample_temps:
                         temp_group = group.create_group(temp)
@@ -89,10 +94,7 @@ def run(scheduler, batch_idx, data_dir, output_dir='.', file_type='source', noh=
                                 repl_group.create_dataset('rmsd', data = origin[pdb][temp][replica]['rmsd'][:])
                                 repl_group.create_dataset('rmsf', data = origin[pdb][temp][replica]['rmsf'][:])
                                 repl_group.create_dataset('box', data = origin[pdb][temp][replica]['box'][:])
-                                solid_secondary_structure = np.zeros(origin[pdb][temp][replica]['dssp'].shape[0])
-                                for i in range(origin[pdb][temp][replica]['dssp'].shape[0]):
-                                    solid_secondary_structure[i] = get_solid_secondary_structure(origin[pdb][temp][replica]['dssp'][i])
-                                
+                                solid_secondary_structure = get_solid_secondary_structure(origin[pdb][temp][replica]['dssp'][:])
                                 repl_group.create_dataset('solid_secondary_structure', data=solid_secondary_structure)
                             
                             elif file_type == 'source':
@@ -100,28 +102,28 @@ def run(scheduler, batch_idx, data_dir, output_dir='.', file_type='source', noh=
                                     repl_group.attrs['max_num_neighbors_5A'] = get_max_neighbors(origin[pdb][temp][replica]['coords'][:], 5.5) # use 5.5 for confidence on the 5A
                                     repl_group.attrs['max_num_neighbors_9A'] = get_max_neighbors(origin[pdb][temp][replica]['coords'][:], 9.5) # use 9.5 for confidence on the 9A
                                     
-                                    # The noh dataset does not have the dssp information, to store it in the source file we need to read the dssp from the original dataset                             
-                                    with h5py.File(opj('/workspace3/mdcath', f"mdcath_dataset_{pdb}.h5"), "r") as ref_h5:
-                                        repl_group.attrs['min_gyration_radius'] = np.min(ref_h5[pdb][temp][replica]['gyrationRadius'][:])
-                                        repl_group.attrs['max_gyration_radius'] = np.max(ref_h5[pdb][temp][replica]['gyrationRadius'][:])
-                                        
-                                        alpha_comp, beta_comp, coil_comp = get_secondary_structure_compositions(ref_h5[pdb][temp][replica]['dssp'])
+                                    repl_group.attrs['min_gyration_radius'] = np.min(ref_h5[pdb][temp][replica]['gyrationRadius'][:])
+                                    repl_group.attrs['max_gyration_radius'] = np.max(ref_h5[pdb][temp][replica]['gyrationRadius'][:])
+                                    
+                                    alpha_comp, beta_comp, coil_comp = get_secondary_structure_compositions(ref_h5[pdb][temp][replica]['dssp'][:1])
 
-                                        repl_group.attrs['alpha'] = alpha_comp
-                                        repl_group.attrs['beta'] = beta_comp
-                                        repl_group.attrs['coil'] = coil_comp
+                                    repl_group.attrs['alpha'] = alpha_comp
+                                    repl_group.attrs['beta'] = beta_comp
+                                    repl_group.attrs['coil'] = coil_comp
                                 else:
                                     repl_group.attrs['min_gyration_radius'] = np.min(origin[pdb][temp][replica]['gyrationRadius'][:])
                                     repl_group.attrs['max_gyration_radius'] = np.max(origin[pdb][temp][replica]['gyrationRadius'][:])
                                     
-                                    alpha_comp, beta_comp, coil_comp = get_secondary_structure_compositions(origin[pdb][temp][replica]['dssp'])
+                                    alpha_comp, beta_comp, coil_comp = get_secondary_structure_compositions(origin[pdb][temp][replica]['dssp'][:1])
 
                                     repl_group.attrs['alpha'] = alpha_comp
                                     repl_group.attrs['beta'] = beta_comp
                                     repl_group.attrs['coil'] = coil_comp
-                                                                
-                                                       
-        shutil.copyfile(tmp_file, resfile) 
+
+        os.replace(tmp_file, resfile)
+    finally:
+        if os.path.exists(tmp_file):
+            os.unlink(tmp_file)
                 
 def launch():
     data_dir = "PATH/TO/MDCATH/DATASET/DIR"
@@ -158,18 +160,14 @@ def launch():
     payload = Payload(scheduler, data_dir, output_dir, file_type, noh_mode)
 
     with concurrent.futures.ProcessPoolExecutor(max_workers) as executor:
-        try:
-            results = list(
-                tqdm(
-                    executor.map(payload.runComputation, toRunBatches),
-                    total=len(toRunBatches),
-                )
-            )
-        except Exception as e:
-            print(e)
-            raise e
-    # this return it's needed for the tqdm progress bar
-    return results
+        futures = [executor.submit(payload.runComputation, batch) for batch in toRunBatches]
+        # the progress bar is updated as soon as a batch is completed, the results (None) are not kept
+        for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures)):
+            try:
+                future.result()
+            except Exception as e:
+                print(e)
+                raise e
 
 if __name__ == "__main__":
     launch()